@@ -14,7 +14,16 @@ from functorch_additional_op_db import additional_op_db
 from torch.testing._internal.common_methods_invocations import DecorateInfo
 import unittest
 import warnings
-import re
+import weakref
+
+# Indexes of all OpInfos, used to look up the OpInfos an xfail refers to.
+_ALL_OPINFOS = tuple(functorch_lagging_op_db) + tuple(additional_op_db)
+_OPINFO_BY_NAME = {}
+_OPINFO_BY_NAME_VARIANT = {}
+for _opinfo in _ALL_OPINFOS:
+    _OPINFO_BY_NAME.setdefault(_opinfo.name, []).append(_opinfo)
+    _OPINFO_BY_NAME_VARIANT.setdefault((_opinfo.name, _opinfo.variant_test_name), []).append(_opinfo)
+del _opinfo
 
 """
 Usage:
@@ -54,54 +63,53 @@ instantiate_parameterized_methods(MyDeviceSpecificTest)
 instantiate_device_type_tests(MyDeviceSpecificTest, globals())
 
 # !!!!! warning !!!!!
-# 1. The method being parameterized over MUST NOT HAVE A DOCSTRING. We'll
-# error out nicely if this happens.
-# 2. All other decorators MUST USE functools.wraps (they must propagate the docstring)
-# `@parameterized` works by storing some metadata in place of the docstring.
-# This takes advantage of how other decorators work (other decorators usually
-# propagate the docstring via functools.wrap).
-# 3. We might not compose with PyTorch testing's @dtypes and @precision
+# 1. All other decorators MUST USE functools.wraps (they must set __wrapped__)
+# `@parameterized` works by storing some metadata in a side table keyed by the
+# decorated function, and finds it again by following __wrapped__.
+# 2. We might not compose with PyTorch testing's @dtypes and @precision
 # decorators. But that is easily fixable. TODO.
 # I think this composes with PyTorch testing's instantiate_device_type_tests.
 """
 
-PARAM_META = '_torch_parameterized_meta'
-
 class ParamMeta():
     def __init__(self):
-        self.stack = []
-
-    def push(self, elt):
-        self.stack.append(elt)
-
-    def pop(self, elt):
-        return self.stack.pop()
-
-def has_param_meta(method):
-    param_meta = getattr(method, '__doc__', None)
-    return param_meta is not None and isinstance(param_meta, ParamMeta)
+        # Parallel tuples: the name of each parameterized argument and the
+        # (case_name, case) pairs it takes.
+        self.arg_names = ()
+        self.case_items = ()
+
+    def push(self, arg_name, case_dict):
+        self.arg_names += (arg_name,)
+        self.case_items += (tuple(case_dict.items()),)
+
+# Maps each function decorated with @parameterized to its ParamMeta.
+_PARAM_META = weakref.WeakKeyDictionary()
+
+def _find_param_meta(method):
+    while method is not None:
+        param_meta = _PARAM_META.get(method)
+        if param_meta is not None:
+            return param_meta
+        method = getattr(method, '__wrapped__', None)
+    return None
 
 def get_param_meta(method):
-    param_meta = getattr(method, '__doc__', None)
+    param_meta = _find_param_meta(method)
     if param_meta is None:
-        method.__doc__ = ParamMeta()
-    if not isinstance(method.__doc__, ParamMeta):
-        raise RuntimeError('Tried to use @parameterized on a method that has '
-                           'a docstring. This is not supported. Please remove '
-                           'the docstring.')
-    return method.__doc__
+        param_meta = _PARAM_META[method] = ParamMeta()
+    return param_meta
 
 def parameterized(arg_name, case_dict):
     def decorator(fn):
         param_meta = get_param_meta(fn)
-        param_meta.push((arg_name, case_dict))
+        param_meta.push(arg_name, case_dict)
         return fn
     return decorator
 
 def parameterized_with_device(arg_name, case_dict):
     def decorator(fn):
         param_meta = get_param_meta(fn)
-        param_meta.push((arg_name, case_dict))
+        param_meta.push(arg_name, case_dict)
         fn._has_device = True
         return fn
     return decorator
@@ -126,54 +134,91 @@ def _set_parameterized_method(test_base, fn, instantiated_cases, extension_name)
         wrapped = wrapped_no_device
 
     wrapped.__name__ = new_name
+    wrapped.__doc__ = fn.__doc__
     setattr(test_base, new_name, wrapped)
 
-def to_tuples(dct):
-    return [(k, v) for k, v in dct.items()]
+def _wraps(attr, fn):
+    while attr is not None:
+        if attr is fn:
+            return True
+        attr = getattr(attr, '__wrapped__', None)
+    return False
 
 def instantiate_parameterized_methods(test_base):
-    allattrs = tuple(dir(test_base))
-    for attr_name in allattrs:
-        attr = getattr(test_base, attr_name)
-        if not has_param_meta(attr):
+    for fn, param_meta in list(_PARAM_META.items()):
+        attr_name = fn.__name__
+        attr = getattr(test_base, attr_name, None)
+        if not _wraps(attr, fn):
             continue
 
-        param_meta = get_param_meta(attr)
-        arg_names, case_dicts = zip(*param_meta.stack)
-        case_dicts = [to_tuples(cd) for cd in case_dicts]
-        for list_of_name_and_case in itertools.product(*case_dicts):
-            case_names, cases = zip(*list_of_name_and_case)
-            extension_name = '_'.join(case_names)
-            instantiated_cases = list(zip(arg_names, cases))
+        for combo in itertools.product(*param_meta.case_items):
+            extension_name = '_'.join(case_name for case_name, _ in combo)
+            instantiated_cases = tuple((arg_name, case)
+                                       for arg_name, (_, case) in zip(param_meta.arg_names, combo))
             _set_parameterized_method(test_base, attr, instantiated_cases, extension_name)
         # Remove the base fn from the testcase
         delattr(test_base, attr_name)
 
 
+# torch.stack used to be much slower than torch.cat; this was fixed in 1.13.
+_STACK_IS_SLOW = tuple(int(v) for v in torch.__version__.split('.')[:2]) < (1, 13)
+
+def _cat_stack(tensors):
+    # Equivalent to torch.stack(tensors), but torch.cat + view avoids the
+    # per-tensor overhead that torch.stack pays on older versions of PyTorch.
+    first = tensors[0]
+    if not _STACK_IS_SLOW or first.layout != torch.strided:
+        return torch.stack(tensors)
+    # torch.cat would accept ragged tensors whose sizes happen to add up
+    assert all(t.shape == first.shape for t in tensors), \
+        f"stack expects each tensor to be equal size, got {[t.shape for t in tensors]}"
+    if first.dim() == 0:
+        tensors = [t.view(1) for t in tensors]
+    return torch.cat(tensors).view(len(tensors), *first.shape)
+
 def loop(op, in_dims, out_dim, batch_size, *batched_args, **kwarg_values):
+    # Slice every batched arg in one call up front rather than calling
+    # select once per (arg, idx)
+    unbound = [a.unbind(in_dim) if in_dim is not None else None
+               for a, in_dim in zip(batched_args, in_dims)]
     outs = []
     for idx in range(batch_size):
-        idx_args = []
-        idx_kwargs = {}
-        for a, in_dim in zip(batched_args, in_dims):
-            idx_args.append(a.select(in_dim, idx) if in_dim is not None else a)
+        idx_args = [u[idx] if u is not None else a for u, a in zip(unbound, batched_args)]
         out = op(*idx_args, **kwarg_values)
         outs.append(out)
-    loop_out = []
     if isinstance(outs[0], torch.Tensor):
-        loop_out = torch.stack(outs)
-    else:
-        for idx in range(len(outs[0])):
-            loop_out.append(torch.stack([i[idx] for i in outs], out_dim))
+        return _cat_stack(outs)
+
+    loop_out = []
+    for k, first in enumerate(outs[0]):
+        column = [out[k] for out in outs]
+        if (first.layout != torch.strided or
+                any(o.shape != first.shape or o.dtype != first.dtype for o in column)):
+            # torch.stack raises on mismatched shapes, promotes dtypes and
+            # handles non-strided layouts
+            loop_out.append(torch.stack(column, out_dim))
+            continue
+        # Copy each output straight into a preallocated buffer rather than
+        # stacking the per-example outputs.
+        result = torch.empty((batch_size, *first.shape), dtype=first.dtype, device=first.device)
+        for b, o in enumerate(column):
+            result[b].copy_(o)
+        loop_out.append(result.movedim(0, out_dim))
     return loop_out
 
 
-def get_exhaustive_batched_inputs(arg_values, kwarg_values, batch_size=3):
+def get_exhaustive_batched_inputs(arg_values, kwarg_values, batch_size=3, materialize=True):
+    # By default the batched inputs are dense copies of the original inputs.
+    # Pass materialize=False to get expanded (stride-0) views instead; only do
+    # so if the op never writes to its inputs.
+    if not any(isinstance(a, torch.Tensor) for a in arg_values):
+        return
+
     def add_batch_dim(arg, bdim, batch_size=3):
         if isinstance(arg, torch.Tensor):
-            shape = [1] * len(arg.shape)
-            shape.insert(bdim, batch_size)
-            return (arg.repeat(shape), bdim)
+            if materialize:
+                return (torch.cat([arg.unsqueeze(bdim)] * batch_size, dim=bdim), bdim)
+            return (arg.unsqueeze(bdim).expand(*arg.shape[:bdim], batch_size, *arg.shape[bdim:]), bdim)
         else:
             return (arg, None)
 
@@ -188,16 +233,66 @@ def get_exhaustive_batched_inputs(arg_values, kwarg_values, batch_size=3):
     for batched_values in itertools.product(*batch_choices):
         batched_args, in_dims = zip(*batched_values)
 
-        if all([i is None for i in in_dims]):
+        if all(i is None for i in in_dims):
             continue
 
         yield batched_args, in_dims, kwarg_values
 
 
-def get_fallback_and_vmap_exhaustive(op, arg_values, kwarg_values, compute_loop_out=True):
+def _chunked_vmap(func, in_dims, out_dims, chunk_size=None):
+    # Like vmap, but runs func over at most chunk_size examples at a time
+    # and concatenates the results. This bounds peak memory for large inputs.
+    if chunk_size is None:
+        return vmap(func, in_dims=in_dims, out_dims=out_dims)
+
+    def wrapped(*args, **kwargs):
+        chunked_args = []
+        for a, in_dim in zip(args, in_dims):
+            if in_dim is None:
+                chunked_args.append(itertools.repeat(a))
+            else:
+                chunked_args.append(a.split(chunk_size, in_dim))
+        chunk_outs = []
+        for chunk in zip(*chunked_args):
+            out = vmap(func, in_dims=in_dims, out_dims=out_dims)(*chunk, **kwargs)
+            chunk_outs.append(pytree.tree_flatten(out))
+        out_spec = chunk_outs[0][1]
+        flat_outs = [torch.cat(leaves, out_dims) if isinstance(leaves[0], torch.Tensor) else leaves[0]
+                     for leaves in zip(*[flat for flat, _ in chunk_outs])]
+        return pytree.tree_unflatten(flat_outs, out_spec)
+    return wrapped
+
+def get_fallback_and_vmap_exhaustive(op, arg_values, kwarg_values, compute_loop_out=True, chunk_size=None):
     out_dim = 0
     batch_size = 3
     generator = get_exhaustive_batched_inputs(arg_values, kwarg_values, batch_size)
+
+    # Tests case where we dispatch to a batching rule with no bdims
+    # Should now be covered by https://github.com/facebookresearch/functorch/pull/63
+    # x is created on the inputs' device so that it usually doesn't need to be
+    # moved to the device of the outputs.
+    device = next((a.device for a in arg_values if isinstance(a, torch.Tensor)), 'cpu')
+    x_on_dev = torch.ones(3, device=device)
+
+    def f(x, *args, **kwargs):
+        out = op(*args, **kwargs)
+        if isinstance(out, torch.Tensor):
+            return out + (x if out.device == x.device else x.to(out.device))
+        out = list(out)
+        for idx, o in enumerate(out):
+            out[idx] = o + (x if o.device == x.device else x.to(o.device))
+        return out
+
+    # Reference for the nested vmap case: broadcasts x_on_dev against v
+    # instead of materializing a fresh torch.ones(3, *v.shape).
+    def add_ones(v):
+        ones = x_on_dev if v.device == x_on_dev.device else x_on_dev.to(v.device)
+        return ones.view(3, *[1] * v.dim()) + v
+
+    # Every element of the generator has one in_dim per element of arg_values
+    vmap1_dims = tuple([0] + [None] * len(arg_values))
+    inner_vmap = vmap(f, in_dims=vmap1_dims)
+
     for batched_args, in_dims, kwarg_values in generator:
         if compute_loop_out:
             loop_out = loop(op, in_dims, out_dim, batch_size, *batched_args, **kwarg_values)
@@ -209,27 +304,18 @@ def get_fallback_and_vmap_exhaustive(op, arg_values, kwarg_values, compute_loop_
         #     return op(a)
         # t = make_fx(vmap(f, in_dims=in_dims, out_dims=out_dim))(*batched_args, **kwarg_values)
         # import pdb; pdb.set_trace()
-        batched_out = vmap(op, in_dims=in_dims, out_dims=out_dim)(*batched_args, **kwarg_values)
+        batched_out = _chunked_vmap(op, in_dims, out_dim, chunk_size)(*batched_args, **kwarg_values)
         yield (loop_out, batched_out)
 
-        # Tests case where we dispatch to a batching rule with no bdims
-        # Should now be covered by https://github.com/facebookresearch/functorch/pull/63
-        def f(x, *args, **kwargs):
-            out = op(*args, **kwargs)
-            if isinstance(out, torch.Tensor):
-                return out + x.to(out.device)
-            out = list(out)
-            for idx in range(len(out)):
-                out[idx] = out[idx] + x.to(out[idx].device)
-            return out
-
-        vmap1_dims = tuple([0] + [None] * len(in_dims))
         vmap2_dims = tuple([None] + list(in_dims))
-        if compute_loop_out:
-            loop_out = pytree.tree_map(lambda v: torch.ones(3, *v.shape, device=v.device) + v, loop_out)
-        else:
+        if not compute_loop_out:
             loop_out = None
-        batched_out = vmap(vmap(f, in_dims=vmap1_dims), in_dims=vmap2_dims)(torch.ones(3), *batched_args, **kwarg_values)
+        elif isinstance(loop_out, torch.Tensor):
+            loop_out = add_ones(loop_out)
+        else:
+            loop_out = pytree.tree_map(add_ones, loop_out)
+        batched_out = _chunked_vmap(inner_vmap, vmap2_dims, 0, chunk_size)(
+            x_on_dev, *batched_args, **kwarg_values)
         yield (loop_out, batched_out)
 
 def opinfo_in_dict(opinfo, d):
@@ -239,17 +325,14 @@ def xfail(op_name, variant_name=None, *, device_type=None, dtypes=None, expected
     return (op_name, variant_name, device_type, dtypes, expected_failure)
 
 def skipOps(test_case_name, base_test_name, to_skip):
-    all_opinfos = functorch_lagging_op_db + additional_op_db
     for xfail in to_skip:
         op_name, variant_name, device_type, dtypes, expected_failure = xfail
         if variant_name is None:
             # match all variants
-            matching_opinfos = [o for o in all_opinfos if o.name == op_name]
-            assert len(matching_opinfos) >= 1, f"Couldn't find OpInfo for {xfail}"
+            matching_opinfos = _OPINFO_BY_NAME.get(op_name, [])
         else:
-            matching_opinfos = [o for o in all_opinfos
-                                if o.name == op_name and o.variant_test_name == variant_name]
-            assert len(matching_opinfos) >= 1, f"Couldn't find OpInfo for {xfail}"
+            matching_opinfos = _OPINFO_BY_NAME_VARIANT.get((op_name, variant_name), [])
+        assert len(matching_opinfos) >= 1, f"Couldn't find OpInfo for {xfail}"
         for opinfo in matching_opinfos:
             decorators = list(opinfo.decorators)
             decorators.append(DecorateInfo(unittest.expectedFailure,
@@ -274,7 +357,7 @@ def check_vmap_fallback(test_case, thunk, opinfo, dry_run=False):
     try:
         with DisableVmapFallback():
             thunk()
-    except:
+    except Exception:
         if not dry_run:
             raise
         if opinfo.variant_test_name:
@@ -25,6 +25,7 @@ from common_utils import (
     parameterized_with_device,
     instantiate_parameterized_methods,
     get_fallback_and_vmap_exhaustive,
+    get_exhaustive_batched_inputs,
     opinfo_in_dict,
     xfail,
     skipOps,
@@ -1132,6 +1133,12 @@ def _make_case(op, input_getter=TensorFactory.randn):
     return (op, input_getter)
 
 
+def _wrap_with_functools_wraps(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return fn(*args, **kwargs)
+    return wrapper
+
 class TestVmapOperators(Namespace.TestVmapBase):
     def _vmap_test(self, *args, **kwargs):
         return _vmap_test(self, *args, **kwargs)
@@ -2581,13 +2588,68 @@ class TestVmapOperators(Namespace.TestVmapBase):
 
     @parameterized('op', {'abs': torch.abs, 'acos': torch.acos})
     def test_parameterize(self, op):
-        pass
+        """Parameterized methods may have a docstring"""
+        self.assertIn(op, (torch.abs, torch.acos))
 
     @parameterized('op2', {'cos': torch.cos, 'cosh': torch.cosh})
     @parameterized('op1', {'sin': torch.sin, 'sinh': torch.sinh})
     def test_parameterize_multiple(self, op1, op2):
         pass
 
+    @parameterized('op2', {'cos': torch.cos, 'cosh': torch.cosh})
+    @_wrap_with_functools_wraps
+    @parameterized('op1', {'sin': torch.sin, 'sinh': torch.sinh})
+    def test_parameterize_wrapped(self, op1, op2):
+        self.assertIn(op1, (torch.sin, torch.sinh))
+        self.assertIn(op2, (torch.cos, torch.cosh))
+
+    def test_parameterize_instantiated(self):
+        self.assertEqual(self.test_parameterize_abs.__doc__,
+                         "Parameterized methods may have a docstring")
+        for name in ('sin_cos', 'sin_cosh', 'sinh_cos', 'sinh_cosh'):
+            self.assertTrue(hasattr(self, f'test_parameterize_multiple_{name}'))
+            self.assertTrue(hasattr(self, f'test_parameterize_wrapped_{name}'))
+        self.assertFalse(hasattr(self, 'test_parameterize'))
+        self.assertFalse(hasattr(self, 'test_parameterize_wrapped'))
+
+    def test_exhaustive_batched_inputs(self):
+        x = torch.randn(2, 3)
+        cases = list(get_exhaustive_batched_inputs([x, 2.], {}))
+        self.assertEqual(len(cases), 1)
+        (batched_x, scalar), in_dims, _ = cases[0]
+        self.assertEqual(in_dims, (0, None))
+        self.assertEqual(scalar, 2.)
+        self.assertEqual(batched_x, x.expand(3, 2, 3))
+        # Batched inputs are dense copies that ops may write to
+        self.assertTrue(batched_x.is_contiguous())
+        self.assertNotEqual(batched_x.data_ptr(), x.data_ptr())
+        batched_x.mul_(2)
+        self.assertEqual(batched_x, 2 * x.expand(3, 2, 3))
+
+        # With materialize=False they are expanded views of the original
+        cases = list(get_exhaustive_batched_inputs([x, 2.], {}, materialize=False))
+        self.assertEqual(len(cases), 1)
+        (batched_x, _), in_dims, _ = cases[0]
+        self.assertEqual(in_dims, (0, None))
+        self.assertEqual(batched_x, x.expand(3, 2, 3))
+        self.assertEqual(batched_x.stride(0), 0)
+        self.assertEqual(batched_x.data_ptr(), x.data_ptr())
+
+    def test_fallback_and_vmap_exhaustive_chunk_size(self):
+        def check(op, args):
+            expected = list(get_fallback_and_vmap_exhaustive(op, args, {}))
+            for chunk_size in (1, 2):
+                result = list(get_fallback_and_vmap_exhaustive(op, args, {}, chunk_size=chunk_size))
+                self.assertEqual(len(result), len(expected))
+                for (loop_out, batched_out), (_, expected_out) in zip(result, expected):
+                    self.assertEqual(batched_out, expected_out)
+                    self.assertEqual(batched_out, loop_out)
+
+        x = torch.randn(2, 3)
+        y = torch.randn(2, 3)
+        check(torch.add, (x, y))
+        check(lambda x, y: (x.sin(), x * y), (x, y))
+
 instantiate_parameterized_methods(TestVmapOperators)
 
 